@@ -7,7 +7,12 @@ import json
 import os
 from datetime import datetime, timedelta
 from functools import wraps
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
+from profiling import SlowRequestProfiler
+from task_queue import BackgroundTaskQueue
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,6 +28,9 @@ else:
     # In development, allow localhost
     CORS(app, origins=['http://localhost:8000', 'http://127.0.0.1:8000'])
 
+# Opt-in slow-request profiling (see PROFILING_* environment variables)
+profiler = SlowRequestProfiler(app)
+
 # Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
@@ -30,6 +38,22 @@ YOUR_SITE_URL = os.getenv('SITE_URL', 'http://localhost:8000')
 YOUR_APP_NAME = os.getenv('APP_NAME', 'AlphaX')
 USERS_FILE = "users.json"
 CHATS_FILE = "chats.json"
+TASK_JOURNAL_FILE = os.getenv('TASK_JOURNAL_FILE', 'tasks.journal')
+GENERATE_CHAT_TITLES = os.getenv('GENERATE_CHAT_TITLES', 'False').lower() == 'true'
+
+# Serializes read-modify-write cycles on the JSON files across request and worker threads
+storage_lock = threading.Lock()
+
+# Post-response work (chat persistence, usage accounting, titles) runs here
+task_queue = BackgroundTaskQueue(
+    journal_path=TASK_JOURNAL_FILE,
+    workers=int(os.getenv('TASK_WORKERS', 2)),
+    max_retries=int(os.getenv('TASK_MAX_RETRIES', 5))
+)
+
+# users.json/chats.json are only locked within a process, so run a single worker
+if int(os.getenv('WEB_CONCURRENCY', 1)) > 1:
+    print("Warning: WEB_CONCURRENCY > 1 is not supported; concurrent workers can lose JSON storage updates")
 
 # Validate required environment variables
 if not OPENROUTER_API_KEY:
@@ -46,10 +70,16 @@ def load_users():
             return {}
     return {}
 
+def write_json_atomic(path, data):
+    """Write JSON to a temp file and swap it in, so readers never see a partial file"""
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
 def save_users(users):
     """Save users to JSON file"""
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=2)
+    write_json_atomic(USERS_FILE, users)
 
 # Chat storage functions
 def load_chats():
@@ -64,8 +94,7 @@ def load_chats():
 
 def save_chats(chats):
     """Save chats to JSON file"""
-    with open(CHATS_FILE, 'w') as f:
-        json.dump(chats, f, indent=2)
+    write_json_atomic(CHATS_FILE, chats)
 
 def get_user_chats(user_id):
     """Get all chats for a specific user"""
@@ -74,44 +103,174 @@ def get_user_chats(user_id):
 
 def save_user_chat(user_id, chat_data):
     """Save a chat for a specific user"""
-    chats = load_chats()
-    if user_id not in chats:
-        chats[user_id] = {}
-    
-    chat_id = chat_data['id']
-    chat_data['updated_at'] = datetime.utcnow().isoformat()
-    
-    # If it's a new chat, add created_at
-    if chat_id not in chats[user_id]:
-        chat_data['created_at'] = datetime.utcnow().isoformat()
-    
-    chats[user_id][chat_id] = chat_data
-    save_chats(chats)
+    with storage_lock:
+        chats = load_chats()
+        if user_id not in chats:
+            chats[user_id] = {}
+        
+        chat_id = chat_data['id']
+        chat_data['updated_at'] = datetime.utcnow().isoformat()
+        
+        # If it's a new chat, add created_at
+        if chat_id not in chats[user_id]:
+            chat_data['created_at'] = datetime.utcnow().isoformat()
+        
+        chats[user_id][chat_id] = chat_data
+        save_chats(chats)
     return chat_data
 
 def delete_user_chat(user_id, chat_id):
     """Delete a specific chat for a user"""
-    chats = load_chats()
-    if user_id in chats and chat_id in chats[user_id]:
-        del chats[user_id][chat_id]
-        save_chats(chats)
-        return True
+    with storage_lock:
+        chats = load_chats()
+        if user_id in chats and chat_id in chats[user_id]:
+            del chats[user_id][chat_id]
+            save_chats(chats)
+            return True
     return False
 
-def create_token(user_id):
+def default_chat_title(message):
+    """Generate a title from the first message (max 40 chars), same as the frontend"""
+    title = message.strip()
+    if len(title) > 40:
+        title = title[:37] + '...'
+    return title
+
+def get_openrouter_headers():
+    """Headers for OpenRouter API requests"""
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "Referer": YOUR_SITE_URL,
+        "X-Title": YOUR_APP_NAME,
+    }
+
+# Background tasks
+@task_queue.task
+def persist_chat_exchange(user_id, chat_id, prompt, response, timestamp):
+    """Insert a prompt/response pair into a chat by timestamp, creating the chat if needed"""
+    with storage_lock:
+        chats = load_chats()
+        user_chats = chats.setdefault(user_id, {})
+        now = datetime.utcnow().isoformat()
+        
+        chat_data = user_chats.get(chat_id)
+        if chat_data is None:
+            chat_data = {
+                'id': chat_id,
+                'title': default_chat_title(prompt),
+                'messages': [],
+                'timestamp': timestamp,
+                'created_at': now
+            }
+            user_chats[chat_id] = chat_data
+        messages = chat_data.setdefault('messages', [])
+        
+        # Skip exchanges that were already saved (tasks can be replayed)
+        already_saved = any(
+            m.get('role') == 'user' and m.get('timestamp') == timestamp and m.get('content') == prompt
+            for m in messages
+        )
+        if not already_saved:
+            # Workers and retries can run out of order, so keep messages sorted by timestamp
+            index = len(messages)
+            while index > 0 and messages[index - 1].get('timestamp', 0) > timestamp:
+                index -= 1
+            previous_first = next((m for m in messages if m.get('role') == 'user'), None)
+            messages[index:index] = [
+                {'role': 'user', 'content': prompt, 'timestamp': timestamp},
+                {'role': 'assistant', 'content': response, 'timestamp': timestamp}
+            ]
+            # An earlier exchange arriving late takes over the placeholder title
+            if (index == 0 and previous_first is not None
+                    and chat_data.get('title') == default_chat_title(previous_first.get('content', ''))):
+                chat_data['title'] = default_chat_title(prompt)
+            chat_data['timestamp'] = max(chat_data.get('timestamp', 0), timestamp)
+            chat_data['updated_at'] = now
+            save_chats(chats)
+        
+        # Title the chat after its first exchange. Checked on every run rather than
+        # only on creation, so a replayed task still queues the title.
+        first_user = next((m for m in messages if m.get('role') == 'user'), None)
+        needs_title = (
+            first_user is not None
+            and first_user.get('timestamp') == timestamp
+            and first_user.get('content') == prompt
+            and chat_data.get('title') == default_chat_title(prompt)
+        )
+    
+    if needs_title and GENERATE_CHAT_TITLES:
+        task_queue.enqueue('generate_chat_title', user_id=user_id, chat_id=chat_id, prompt=prompt)
+
+@task_queue.task
+def record_usage(user_id, usage=None, request_id=None):
+    """Update a user's chat count and token usage totals"""
+    with storage_lock:
+        users = load_users()
+        if user_id not in users:
+            return
+        
+        user = users[user_id]
+        
+        # Skip requests that were already counted (tasks can be replayed)
+        applied = user.setdefault('recent_usage_ids', [])
+        if request_id:
+            if request_id in applied:
+                return
+            applied.append(request_id)
+            del applied[:-100]
+        
+        user['chat_count'] = user.get('chat_count', 0) + 1
+        totals = user.setdefault('usage', {})
+        for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+            totals[key] = totals.get(key, 0) + ((usage or {}).get(key) or 0)
+        save_users(users)
+
+@task_queue.task
+def generate_chat_title(user_id, chat_id, prompt):
+    """Replace a new chat's placeholder title with a short LLM-generated one"""
+    response = requests.post(
+        "https://openrouter.ai/api/v1/chat/completions",
+        headers=get_openrouter_headers(),
+        json={
+            "model": "openai/gpt-4o-mini",
+            "messages": [
+                {"role": "system", "content": "Write a short title (at most 6 words) for a conversation that starts with the user's message. Reply with the title only, no quotes or punctuation at the end."},
+                {"role": "user", "content": prompt[:2000]}
+            ],
+            "temperature": 0.3,
+            "max_tokens": 20
+        },
+        timeout=30
+    )
+    response.raise_for_status()
+    title = response.json()["choices"][0]["message"]["content"].strip().strip('"\'').strip()
+    if not title:
+        return
+    
+    with storage_lock:
+        chats = load_chats()
+        chat_data = chats.get(user_id, {}).get(chat_id)
+        # Leave the title alone if the chat is gone or was renamed meanwhile
+        if chat_data is None or chat_data.get('title') != default_chat_title(prompt):
+            return
+        chat_data['title'] = title[:60]
+        save_chats(chats)
+
+def create_token(user_id, name=None):
     """Create JWT token for user"""
     payload = {
         'user_id': user_id,
+        'name': name,  # Lets chat() build its prompt without reading users.json
         'exp': datetime.utcnow() + timedelta(days=7),  # Token expires in 7 days
         'iat': datetime.utcnow()
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
 
 def verify_token(token):
-    """Verify JWT token and return user_id"""
+    """Verify JWT token and return its payload"""
     try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload['user_id']
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
@@ -126,13 +285,14 @@ def require_auth(f):
             return jsonify({'error': 'Missing or invalid authorization header'}), 401
         
         token = auth_header.split(' ')[1]
-        user_id = verify_token(token)
+        payload = verify_token(token)
         
-        if not user_id:
+        if not payload or not payload.get('user_id'):
             return jsonify({'error': 'Invalid or expired token'}), 401
         
-        # Add user_id to request context
-        request.current_user_id = user_id
+        # Add user_id (and name, for tokens that carry it) to request context
+        request.current_user_id = payload['user_id']
+        request.current_user_name = payload.get('name')
         return f(*args, **kwargs)
     
     return decorated_function
@@ -179,13 +339,6 @@ def register():
     if '@' not in email or '.' not in email:
         return jsonify({"error": "Please enter a valid email address"}), 400
     
-    # Load existing users
-    users = load_users()
-    
-    # Check if user already exists
-    if email in users:
-        return jsonify({"error": "User with this email already exists"}), 409
-    
     # Create new user
     user_data = {
         'email': email,
@@ -195,11 +348,19 @@ def register():
         'chat_count': 0
     }
     
-    users[email] = user_data
-    save_users(users)
+    with storage_lock:
+        # Load existing users
+        users = load_users()
+        
+        # Check if user already exists
+        if email in users:
+            return jsonify({"error": "User with this email already exists"}), 409
+        
+        users[email] = user_data
+        save_users(users)
     
     # Create token
-    token = create_token(email)
+    token = create_token(email, name)
     
     return jsonify({
         "message": "User registered successfully",
@@ -239,7 +400,7 @@ def login():
         return jsonify({"error": "Invalid email or password"}), 401
     
     # Create token
-    token = create_token(email)
+    token = create_token(email, user['name'])
     
     return jsonify({
         "message": "Login successful",
@@ -279,16 +440,19 @@ def chat():
     data = request.get_json()
     prompt = data.get("prompt", "").strip()
     messages = data.get("messages", [])
+    chat_id = data.get("chat_id")
     
     if not prompt:
         return jsonify({"error": "Missing prompt"}), 400
 
-    # Update user chat count
-    users = load_users()
     user_id = request.current_user_id
-    if user_id in users:
-        users[user_id]['chat_count'] = users[user_id].get('chat_count', 0) + 1
-        save_users(users)
+    user_name = request.current_user_name
+    if not user_name:
+        # Tokens issued before the name was added to the payload
+        user = load_users().get(user_id)
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        user_name = user['name']
 
     # Build conversation context
     conversation = []
@@ -296,7 +460,7 @@ def chat():
     # Add system message for better ChatGPT-like responses
     system_message = {
         "role": "system",
-        "content": f"""You are AlphaX, a helpful, harmless, and honest AI assistant. You are chatting with {users[user_id]['name']}. You should:
+        "content": f"""You are AlphaX, a helpful, harmless, and honest AI assistant. You are chatting with {user_name}. You should:
 
 1. Provide clear, well-structured responses
 2. Use markdown formatting when appropriate (headers, lists, code blocks, etc.)
@@ -322,12 +486,7 @@ Always aim to be as helpful as possible while maintaining accuracy."""
     conversation.append({"role": "user", "content": prompt})
 
     # Send to OpenRouter
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "Referer": YOUR_SITE_URL,
-        "X-Title": YOUR_APP_NAME,
-    }
+    headers = get_openrouter_headers()
 
     payload = {
         "model": "openai/gpt-4o-mini",
@@ -350,12 +509,28 @@ Always aim to be as helpful as possible while maintaining accuracy."""
         if response.status_code == 200:
             result = response.json()
             ai_response = result["choices"][0]["message"]["content"]
+            usage = result.get("usage") or {}
+            timestamp = int(time.time() * 1000)
+            
+            # Persistence and accounting happen after the response is sent
+            task_queue.enqueue('record_usage', user_id=user_id, usage=usage,
+                               request_id=uuid.uuid4().hex)
+            if chat_id:
+                task_queue.enqueue(
+                    'persist_chat_exchange',
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    prompt=prompt,
+                    response=ai_response,
+                    timestamp=timestamp
+                )
             
             return jsonify({
                 "response": ai_response,
                 "model": payload["model"],
-                "usage": result.get("usage", {}),
-                "user_chat_count": users[user_id].get('chat_count', 0)
+                "usage": usage,
+                "chat_id": chat_id,
+                "timestamp": timestamp
             })
         else:
             error_detail = response.text
@@ -496,6 +671,14 @@ def get_models():
     ]
     return jsonify({"models": models})
 
+# Start background workers (replays any tasks left in the journal). With
+# `python app.py` in debug mode the werkzeug reloader imports this module in a
+# parent process too; only the serving child should own the journal.
+if not (__name__ == '__main__'
+        and os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+        and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'):
+    task_queue.start()
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Endpoint not found"}), 404
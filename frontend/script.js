@@ -484,7 +484,8 @@ class ChatApp {
                 },
                 body: JSON.stringify({ 
                     prompt: message,
-                    messages: conversationHistory
+                    messages: conversationHistory,
+                    chat_id: this.currentChatId
                 })
             });
 
@@ -506,15 +507,13 @@ class ChatApp {
             // Add assistant response with streaming effect
             await this.addStreamingMessage(data.response, 'assistant');
             
-            // Update user stats if provided
-            if (data.user_chat_count) {
-                this.currentUser.chat_count = data.user_chat_count;
-                localStorage.setItem('currentUser', JSON.stringify(this.currentUser));
-                this.updateUserInfo();
-            }
+            // Chat count is updated in the background on the server; count locally
+            this.currentUser.chat_count = (this.currentUser.chat_count || 0) + 1;
+            localStorage.setItem('currentUser', JSON.stringify(this.currentUser));
+            this.updateUserInfo();
             
-            // Save chat to server
-            await this.saveCurrentChatToServer(message, data.response);
+            // Save chat (the server persists it itself when it returns chat_id)
+            await this.saveCurrentChatToServer(message, data.response, data.chat_id ? data.timestamp : null);
 
         } catch (error) {
             console.error('Error sending message:', error);
@@ -923,7 +922,7 @@ class ChatApp {
         localStorage.setItem('chats', JSON.stringify(this.chats));
     }
 
-    async saveCurrentChatToServer(userMessage, assistantResponse) {
+    async saveCurrentChatToServer(userMessage, assistantResponse, serverTimestamp = null) {
         let chat = this.chats.find(c => c.id === this.currentChatId);
         
         if (!chat) {
@@ -936,20 +935,27 @@ class ChatApp {
             this.chats.unshift(chat);
         }
         
+        // Use the server's timestamp for server-saved chats so the next sync
+        // doesn't treat the local copy as newer and overwrite the server's
+        const timestamp = serverTimestamp || Date.now();
         chat.messages.push(
-            { role: 'user', content: userMessage, timestamp: Date.now() },
-            { role: 'assistant', content: assistantResponse, timestamp: Date.now() }
+            { role: 'user', content: userMessage, timestamp: timestamp },
+            { role: 'assistant', content: assistantResponse, timestamp: timestamp }
         );
         
         // Update timestamp
-        chat.timestamp = Date.now();
+        chat.timestamp = timestamp;
         
         // Move to top
         this.chats = this.chats.filter(c => c.id !== this.currentChatId);
         this.chats.unshift(chat);
         
-        // Save to server
-        await this.saveChatToServer(chat);
+        // Save to server unless the chat endpoint already queued it
+        if (serverTimestamp) {
+            this.saveToLocalStorage();
+        } else {
+            await this.saveChatToServer(chat);
+        }
         
         // Update UI
         this.updateChatHistory();
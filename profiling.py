@@ -0,0 +1,241 @@
+"""
+Slow-request profiling for AlphaX
+Opt-in cProfile + stack sampling that keeps dumps only for slow requests
+"""
+
+import cProfile
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import request, jsonify, send_from_directory, g
+
+
+class SlowRequestProfiler:
+    """Profile API requests and keep dumps for the ones above a latency threshold.
+
+    Profiling is enabled for every request with PROFILING_ENABLED=true (subject
+    to PROFILE_SAMPLE_RATE), or for a single request by sending the
+    X-Profile-Token header matching PROFILE_ADMIN_TOKEN. Dumps are written to a
+    bounded ring of files in PROFILE_DIR; the oldest ones are removed first.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = os.getenv('PROFILING_ENABLED', 'False').lower() == 'true'
+        self.admin_token = os.getenv('PROFILE_ADMIN_TOKEN', '')
+        self.threshold_ms = float(os.getenv('PROFILE_THRESHOLD_MS', 500))
+        self.sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', 1.0))
+        self.sample_interval = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5)) / 1000
+        self.max_profiles = max(1, int(os.getenv('PROFILE_MAX_FILES', 20)))
+        self.profile_dir = os.path.abspath(os.getenv('PROFILE_DIR', 'profiles'))
+
+        # cProfile is per-thread up to 3.11; from 3.12 it uses sys.monitoring, so
+        # only one instance can be active per process and it sees every thread
+        self.process_wide_cprofile = sys.version_info >= (3, 12)
+        self._cprofile_lock = threading.Lock()
+        self._ring_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register request hooks and the admin endpoints on the Flask app"""
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._cleanup)
+
+        app.add_url_rule('/api/admin/profiles', 'list_profiles',
+                         self.list_profiles, methods=['GET'])
+        app.add_url_rule('/api/admin/profiles/<profile_id>/<kind>', 'get_profile',
+                         self.get_profile, methods=['GET'])
+
+    def is_admin(self):
+        """Check the X-Profile-Token header against PROFILE_ADMIN_TOKEN"""
+        token = request.headers.get('X-Profile-Token', '')
+        if not self.admin_token or not token:
+            return False
+        # compare_digest only accepts ASCII str, and header values may not be
+        return hmac.compare_digest(token.encode('utf-8'), self.admin_token.encode('utf-8'))
+
+    def _should_profile(self):
+        """Decide whether the current request gets profiled"""
+        if not request.path.startswith('/api/') or request.path.startswith('/api/admin/'):
+            return False
+        if self.is_admin():
+            return True
+        return self.enabled and random.random() < self.sample_rate
+
+    def _start(self):
+        if not self._should_profile():
+            return
+
+        g.profile_started = time.perf_counter()
+        g.profile_sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+        g.profile_sampler.start()
+
+        g.profile_cprofile = None
+        if self.process_wide_cprofile and not self._cprofile_lock.acquire(blocking=False):
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profile_cprofile = profiler
+        except ValueError:
+            # Another profiling tool (e.g. a debugger) is already active
+            if self.process_wide_cprofile:
+                self._cprofile_lock.release()
+
+    def _stop(self):
+        """Stop any profilers running for this request and return them"""
+        profiler = g.pop('profile_cprofile', None)
+        if profiler is not None:
+            profiler.disable()
+            if self.process_wide_cprofile:
+                self._cprofile_lock.release()
+
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+        return profiler, sampler
+
+    def _finish(self, response):
+        started = g.pop('profile_started', None)
+        if started is None:
+            return response
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        profiler, sampler = self._stop()
+
+        if elapsed_ms >= self.threshold_ms or self.is_admin():
+            try:
+                profile_id = self._write_profile(profiler, sampler, elapsed_ms,
+                                                 response.status_code)
+                response.headers['X-Profile-Id'] = profile_id
+            except OSError as e:
+                print(f"Error writing profile: {str(e)}")
+
+        return response
+
+    def _cleanup(self, error=None):
+        # Make sure profilers are released if the request errored before after_request
+        if 'profile_started' in g:
+            g.pop('profile_started')
+            self._stop()
+
+    def _write_profile(self, profiler, sampler, elapsed_ms, status_code):
+        """Write the dumps for one request and trim the ring to max_profiles"""
+        profile_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(self.profile_dir, profile_id)
+
+        with self._ring_lock:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+            files = []
+            if profiler is not None:
+                profiler.dump_stats(f"{base}.prof")
+                files.append('prof')
+            if sampler is not None:
+                with open(f"{base}.collapsed", 'w') as f:
+                    for stack, count in sampler.stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+                files.append('collapsed')
+
+            metadata = {
+                'id': profile_id,
+                'method': request.method,
+                'path': request.path,
+                'status': status_code,
+                'duration_ms': round(elapsed_ms, 2),
+                'samples': sum(sampler.stacks.values()) if sampler is not None else 0,
+                'files': files,
+                # On 3.12+ the .prof dump also includes other threads' work
+                'cprofile_scope': 'process' if self.process_wide_cprofile else 'thread',
+                'created_at': datetime.utcnow().isoformat()
+            }
+            with open(f"{base}.json", 'w') as f:
+                json.dump(metadata, f, indent=2)
+
+            self._trim_ring()
+
+        return profile_id
+
+    def _trim_ring(self):
+        profile_ids = sorted(name[:-len('.json')] for name in os.listdir(self.profile_dir)
+                             if name.endswith('.json'))
+        for profile_id in profile_ids[:-self.max_profiles]:
+            for ext in ('json', 'prof', 'collapsed'):
+                try:
+                    os.remove(os.path.join(self.profile_dir, f"{profile_id}.{ext}"))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self):
+        """List recent slow-request profiles (newest first)"""
+        if not self.is_admin():
+            return jsonify({'error': 'Missing or invalid profile token'}), 403
+
+        profiles = []
+        if os.path.isdir(self.profile_dir):
+            for name in sorted(os.listdir(self.profile_dir), reverse=True):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.profile_dir, name), 'r') as f:
+                        profiles.append(json.load(f))
+                except (json.JSONDecodeError, FileNotFoundError):
+                    continue
+
+        return jsonify({
+            'profiles': profiles,
+            'threshold_ms': self.threshold_ms,
+            'enabled': self.enabled
+        })
+
+    def get_profile(self, profile_id, kind):
+        """Download a cProfile (.prof) or collapsed-stack dump"""
+        if not self.is_admin():
+            return jsonify({'error': 'Missing or invalid profile token'}), 403
+        if kind not in ('prof', 'collapsed'):
+            return jsonify({'error': 'Profile kind must be prof or collapsed'}), 400
+
+        path = os.path.join(self.profile_dir, f"{profile_id}.{kind}")
+        if not os.path.isfile(path):
+            return jsonify({'error': 'Profile not found'}), 404
+        return send_from_directory(self.profile_dir, f"{profile_id}.{kind}",
+                                   as_attachment=True)
+
+
+class _StackSampler(threading.Thread):
+    """Periodically sample one thread's stack into collapsed-stack counts"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name}@{os.path.basename(code.co_filename)}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,331 @@
+"""
+Background task queue for AlphaX
+In-process worker pool with a local journal for retries and restart recovery
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no journal locking, so only run one process per journal
+    fcntl = None
+
+
+class BackgroundTaskQueue:
+    """Run registered tasks on a bounded pool of worker threads.
+
+    Every task is appended (and fsynced) to a JSON-lines journal before it is
+    queued and marked done once it succeeds, so tasks that were pending when the process
+    stopped are replayed on the next start. Failed tasks are retried with
+    exponential backoff up to max_retries. Delivery is at-least-once, so
+    tasks should be safe to run twice.
+
+    Each process writes its own journal (journal_path suffixed with the pid)
+    and holds a lock on it while alive. On start, journals left behind by
+    processes that have exited are adopted and replayed.
+    """
+
+    def __init__(self, journal_path='tasks.journal', workers=2, max_size=1000,
+                 max_retries=5, retry_backoff=1, drain_timeout=10):
+        self.journal_base = journal_path
+        self.journal_path = None
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.drain_timeout = drain_timeout
+
+        self._handlers = {}
+        self._pending = {}
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._timers = set()
+        self._journal_lock = threading.Lock()
+        self._journal_entries = 0
+        self._owner_lock = None
+        self._accepting = False
+
+    def task(self, f):
+        """Decorator to register a function as a task handler by name"""
+        self._handlers[f.__name__] = f
+        return f
+
+    def start(self):
+        """Replay pending tasks from the journal and start the workers"""
+        if self._threads:
+            return
+
+        with self._journal_lock:
+            self._claim_journals()
+
+        self._accepting = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"task-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        for record in list(self._pending.values()):
+            self._schedule(record)
+
+        atexit.register(self.shutdown)
+        if self._pending:
+            print(f"Replaying {len(self._pending)} pending background task(s)")
+
+    def enqueue(self, name, **kwargs):
+        """Journal a task and hand it to the worker pool.
+
+        kwargs must be JSON serializable. If the queue is full the task runs
+        in the calling thread instead.
+        """
+        if name not in self._handlers:
+            raise ValueError(f"Unknown task: {name}")
+
+        record = {
+            'id': uuid.uuid4().hex,
+            'task': name,
+            'kwargs': kwargs,
+            'attempts': 0,
+            'enqueued_at': time.time()
+        }
+        self._journal('enqueue', record)
+
+        if not self._accepting:
+            # Shutting down; the journal entry is replayed on the next start
+            return record['id']
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._run(record)
+        return record['id']
+
+    def shutdown(self, timeout=None):
+        """Stop accepting work and wait for queued tasks to finish.
+
+        Tasks that do not finish within the timeout (and pending retries) stay
+        in the journal and are replayed on the next start.
+        """
+        if not self._accepting:
+            return
+        self._accepting = False
+
+        for timer in list(self._timers):
+            timer.cancel()
+
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        with self._journal_lock:
+            self._compact_journal()
+            if not self._pending:
+                self._release_journal()
+
+    def pending_count(self):
+        """Number of tasks that have not completed yet"""
+        return len(self._pending)
+
+    def _worker(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                self._run(record)
+            except Exception as e:
+                print(f"Background worker error: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _run(self, record):
+        handler = self._handlers.get(record['task'])
+        if handler is None:
+            print(f"Dropping task with no handler: {record['task']}")
+            self._journal('done', record)
+            return
+
+        try:
+            handler(**record['kwargs'])
+        except Exception as e:
+            record['attempts'] += 1
+            if record['attempts'] > self.max_retries:
+                print(f"Task {record['task']} failed after {record['attempts']} attempts: {str(e)}")
+                self._journal('failed', record)
+                return
+
+            print(f"Task {record['task']} failed (attempt {record['attempts']}), retrying: {str(e)}")
+            self._journal('retry', record)
+            self._schedule(record, delay=min(60, self.retry_backoff * 2 ** record['attempts']))
+            return
+
+        self._journal('done', record)
+
+    def _schedule(self, record, delay=0):
+        """Queue a record now, or after a delay for retries"""
+        if not self._accepting:
+            return
+        if delay <= 0:
+            self._queue.put(record)
+            return
+
+        def fire():
+            self._timers.discard(timer)
+            if self._accepting:
+                self._queue.put(record)
+
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        self._timers.add(timer)
+        timer.start()
+
+    def _journal(self, op, record):
+        """Append an entry to the journal and track the pending set"""
+        with self._journal_lock:
+            if op in ('enqueue', 'retry'):
+                self._pending[record['id']] = record
+            else:
+                self._pending.pop(record['id'], None)
+
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps({'op': op, **record}) + '\n')
+                # New work must survive a host crash; a lost 'done' only means a replay
+                if op in ('enqueue', 'retry'):
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._journal_entries += 1
+
+            # Keep the journal from growing without bound
+            if self._journal_entries > 1000 and self._journal_entries > 4 * len(self._pending):
+                self._compact_journal()
+
+    def _claim_journals(self):
+        """Take over this process's journal plus any orphaned ones (caller holds the lock)"""
+        self.journal_path = f"{self.journal_base}.{os.getpid()}"
+
+        with self._adoption_lock():
+            self._owner_lock = self._try_lock(f"{self.journal_path}.lock")
+
+            pending = {}
+            orphans = []
+            for path in self._journal_files():
+                if path == self.journal_base:
+                    # Pre-pid journal; nothing writes it any more
+                    orphans.append((path, None))
+                elif path != self.journal_path:
+                    lock = self._try_lock(f"{path}.lock")
+                    if lock is None:
+                        # Owned by a process that is still running
+                        continue
+                    orphans.append((path, lock))
+                pending.update(self._read_journal(path))
+
+            # Write the merged journal before deleting the ones it replaces
+            self._pending = pending
+            self._compact_journal()
+
+            for path, lock in orphans:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                if lock is not None:
+                    os.remove(f"{path}.lock")
+                    lock.close()
+
+    def _release_journal(self):
+        """Remove this process's journal once nothing is pending (caller holds the lock)"""
+        with self._adoption_lock():
+            for path in (self.journal_path, f"{self.journal_path}.lock"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            if self._owner_lock is not None:
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def _fsync_dir(self):
+        """Make a rename in the journal directory durable (not supported on Windows)"""
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.journal_path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _journal_files(self):
+        """The legacy single journal plus every per-process journal"""
+        paths = [self.journal_base] if os.path.exists(self.journal_base) else []
+        for path in glob.glob(f"{glob.escape(self.journal_base)}.*"):
+            if path.rsplit('.', 1)[1].isdigit():
+                paths.append(path)
+        return paths
+
+    @contextmanager
+    def _adoption_lock(self):
+        """Serialize journal adoption across processes"""
+        with open(f"{self.journal_base}.lock", 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _try_lock(self, path):
+        """Take an exclusive lock on path without blocking; None if another process holds it"""
+        f = open(path, 'a')
+        if fcntl is None:
+            return f
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def _read_journal(self, path):
+        """Rebuild the pending set from a journal file"""
+        pending = {}
+        if not os.path.exists(path):
+            return pending
+
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partially written last line from a crash
+                    continue
+                op = entry.pop('op', None)
+                if op in ('enqueue', 'retry'):
+                    pending[entry['id']] = entry
+                else:
+                    pending.pop(entry.get('id'), None)
+        return pending
+
+    def _compact_journal(self):
+        """Rewrite the journal with only pending tasks (caller holds the lock)"""
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for record in self._pending.values():
+                f.write(json.dumps({'op': 'enqueue', **record}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self._fsync_dir()
+        self._journal_entries = len(self._pending)
@@ -0,0 +1,138 @@
+"""
+Tests for the background task queue and the chat tasks built on it
+Run with: python -m pytest
+"""
+
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from task_queue import BackgroundTaskQueue
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for(condition, timeout=5):
+    """Poll until condition() is true or fail after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail("Timed out waiting for background tasks")
+        time.sleep(0.01)
+
+
+def read_ops(path):
+    with open(path, 'r') as f:
+        return [json.loads(line)['op'] for line in f]
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """Import app with its JSON storage in a temp directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'test-key')
+    monkeypatch.setenv('TASK_JOURNAL_FILE', str(tmp_path / 'tasks.journal'))
+    module = importlib.import_module('app')
+    monkeypatch.setattr(module, 'GENERATE_CHAT_TITLES', True)
+    return module
+
+
+def test_journal_is_replayed_after_crash(tmp_path):
+    journal = tmp_path / 'tasks.journal'
+    crashing = f"""
+import os, threading
+from task_queue import BackgroundTaskQueue
+queue = BackgroundTaskQueue({str(journal)!r}, workers=1)
+@queue.task
+def slow(n):
+    threading.Event().wait()
+queue.start()
+for n in range(3):
+    queue.enqueue('slow', n=n)
+os._exit(1)
+"""
+    subprocess.run([sys.executable, '-c', crashing], cwd=REPO_DIR, check=False)
+    # A torn write from the crash must not stop the replay
+    orphan = next(tmp_path.glob('tasks.journal.[0-9]*'))
+    with open(orphan, 'a') as f:
+        f.write('{"op": "done", "id"')
+
+    ran = []
+    queue = BackgroundTaskQueue(str(journal), workers=1)
+
+    @queue.task
+    def slow(n):
+        ran.append(n)
+
+    queue.start()
+    wait_for(lambda: len(ran) == 3)
+    queue.shutdown()
+
+    assert sorted(ran) == [0, 1, 2]
+    assert queue.pending_count() == 0
+    assert not list(tmp_path.glob('tasks.journal.[0-9]*'))
+
+
+def test_task_is_retried_then_marked_failed(tmp_path):
+    journal = tmp_path / 'tasks.journal'
+    queue = BackgroundTaskQueue(str(journal), workers=1, max_retries=2, retry_backoff=0.01)
+    attempts = []
+
+    @queue.task
+    def broken():
+        attempts.append(1)
+        raise RuntimeError('boom')
+
+    queue.start()
+    queue.enqueue('broken')
+    wait_for(lambda: queue.pending_count() == 0)
+
+    assert len(attempts) == 3
+    assert read_ops(queue.journal_path) == ['enqueue', 'retry', 'retry', 'failed']
+    queue.shutdown()
+
+    # A failed task is not replayed on the next start
+    replayed = BackgroundTaskQueue(str(journal), workers=1)
+    replayed.task(broken)
+    replayed.start()
+    assert replayed.pending_count() == 0
+    replayed.shutdown()
+    assert len(attempts) == 3
+
+
+def test_persist_chat_exchange_out_of_order_and_replayed(app_module, monkeypatch):
+    titled = []
+    monkeypatch.setattr(app_module.task_queue, 'enqueue',
+                        lambda name, **kwargs: titled.append(kwargs['prompt']))
+
+    exchanges = [('second', 200), ('first', 100), ('third', 300)]
+    for prompt, timestamp in exchanges + exchanges:
+        app_module.persist_chat_exchange('a@b.co', 'c1', prompt, f"re: {prompt}", timestamp)
+
+    chat_data = app_module.load_chats()['a@b.co']['c1']
+    assert [m['content'] for m in chat_data['messages']] == [
+        'first', 're: first', 'second', 're: second', 'third', 're: third'
+    ]
+    assert chat_data['title'] == 'first'
+    assert chat_data['timestamp'] == 300
+    # The title is (re)queued only for the exchange that is currently first
+    assert set(titled) == {'second', 'first'}
+    assert titled[-1] == 'first'
+
+
+def test_record_usage_counts_replayed_request_once(app_module):
+    app_module.save_users({'a@b.co': {'email': 'a@b.co', 'name': 'A', 'chat_count': 0}})
+    usage = {'prompt_tokens': 3, 'completion_tokens': 2, 'total_tokens': 5}
+
+    app_module.record_usage('a@b.co', usage, request_id='req-1')
+    app_module.record_usage('a@b.co', usage, request_id='req-1')
+    app_module.record_usage('a@b.co', None, request_id='req-2')
+
+    user = app_module.load_users()['a@b.co']
+    assert user['chat_count'] == 2
+    assert user['usage'] == usage